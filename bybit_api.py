@@ -1,18 +1,84 @@
 # bybit_api.py
 import time
 import logging
-import math
 import hmac
 import hashlib
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
+import numpy as np
+import orjson
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import FileCache
 
 BYBIT_BASE = "https://api.bybit.com"  # v5 unified
+KLINE_FIELDS = ("ts", "open", "high", "low", "close", "volume", "turnover")
+# retCode, которые приходят с HTTP 200 (urllib3 их не видит), но стоят повтора:
+# лимит запросов (по UID / по IP) и временные ошибки сервера (Server Timeout / Server error)
+RATE_LIMIT_CODES = ("10006", "10018")
+SERVER_ERROR_CODES = ("10000", "10016")
 
 def _hmac_sha256(secret: str, payload: str) -> str:
     return hmac.new(secret.encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).hexdigest()
 
+def cached(ttl: int):
+    """
+    Кэширует результат метода BybitAPI в self.cache по ключу bybit_{method}_{category}.
+    Без self.cache метод вызывается как есть; пустой результат не кэшируется.
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return fn(self, *args, **kwargs)
+            key = f"bybit_{fn.__name__}_{self.category}"
+            data = self.cache.get(key, ttl)
+            if data:
+                logging.info(f"{fn.__name__}: взято из кэша ({len(data)} шт.)")
+                return data
+            data = fn(self, *args, **kwargs)
+            # пустой ответ не кэшируем, иначе бот на весь TTL останется без символов
+            if data:
+                self.cache.set(key, data)
+            return data
+        return wrapper
+    return deco
+
+class RateLimitError(RuntimeError):
+    """Bybit ответил retCode лимита запросов — такой ответ стоит повторить."""
+
+class ServerError(RuntimeError):
+    """Bybit ответил retCode временной ошибки сервера — такой ответ стоит повторить."""
+
+class RateLimiter:
+    """
+    Token bucket, общий для всех потоков: держит потолок rate запросов/сек.
+    Медленный ответ сам "оплачивает" паузу — лишнего сна нет.
+    """
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # резервируем токен сразу, ждём уже без блокировки
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
 class BybitAPI:
     def __init__(
         self,
@@ -23,139 +89,162 @@ class BybitAPI:
         api_key: Optional[str] = None,
         api_secret: Optional[str] = None,
         recv_window: int = 20000,
+        workers: int = 8,
+        max_rps: float = 0.0,
+        cache: Optional[FileCache] = None,
     ):
         self.category = category
         self.sleep_ms = sleep_ms
-        self.session = requests.Session()
         self.max_retries = max_retries
         self.retry_backoff_sec = retry_backoff_sec
+        self.session = requests.Session()
+        # Повторы на уровне транспорта: экспоненциальный backoff, 429/5xx и Retry-After.
+        # 403 не повторяем: это бан IP (~10 мин) или блокировка региона — сразу отдаём в _check
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=retry_backoff_sec,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            respect_retry_after_header=True,
+            raise_on_status=False,  # последний ответ разберёт _check
+        )
+        # Пул соединений под число воркеров: дефолтный (10) при WORKERS=8+ переполняется,
+        # лишние соединения выбрасываются и каждый раз платят новый TLS-handshake.
+        pool_size = max(workers * 2, 32)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
         self.api_key = api_key or ""
         self.api_secret = api_secret or ""
         self.recv_window = recv_window
-
-    def _sleep(self):
-        time.sleep(self.sleep_ms / 1000.0)
+        # По умолчанию тот же потолок, что давали паузы sleep_ms на каждом из воркеров
+        if not max_rps and sleep_ms > 0:
+            max_rps = workers * 1000.0 / sleep_ms
+        self._limiter = RateLimiter(rate=max_rps)
+        # Базовые параметры запросов собираем один раз; в вызовах — только копия с переменными полями,
+        # сами словари общие для всех потоков и не мутируются
+        self._tickers_params = {"category": category}
+        self._kline_params = {"category": category, "limit": 200}
+        self._oi_params = {"category": category, "limit": 1}
+        self.cache = cache
+        # один поток для упреждающей загрузки следующей страницы пагинации
+        self._pager = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bybit-page")
+        # Ответы — небольшой JSON: читаем тело сразу и возвращаем соединение в пул
+        self.session.stream = False
+        # Для публичных v5 подпись не обязательна; ключ просто кладём в заголовки сессии
+        self.session.headers.update({"Accept": "application/json", "Connection": "keep-alive"})
+        if self.api_key:
+            self.session.headers["X-BAPI-API-KEY"] = self.api_key
 
     def _check(self, r: requests.Response) -> Dict[str, Any]:
         if r.status_code != 200:
             raise RuntimeError(f"HTTP {r.status_code}: {r.text}")
-        data = r.json()
+        data = orjson.loads(r.content)  # байты парсятся напрямую, без decode в str
         # retCode != 0 => ошибка/лимит/и пр.
-        if str(data.get("retCode")) != "0":
+        code = str(data.get("retCode"))
+        if code in RATE_LIMIT_CODES:
+            raise RateLimitError(f"Bybit rate limit retCode={code} retMsg={data.get('retMsg')}")
+        if code in SERVER_ERROR_CODES:
+            raise ServerError(f"Bybit server error retCode={code} retMsg={data.get('retMsg')}")
+        if code != "0":
             raise RuntimeError(f"Bybit error retCode={data.get('retCode')} retMsg={data.get('retMsg')} data={data}")
         return data
 
-    def _headers_public(self) -> Dict[str, str]:
-        # Для публичных v5 подпись не обязательна; можем просто добавить ключ
-        h = {"Accept": "application/json"}
-        if self.api_key:
-            h["X-BAPI-API-KEY"] = self.api_key
-        return h
-
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+    def _get(self, path: str, params: Dict[str, Any], timeout: int = 20) -> Dict[str, Any]:
+        # Единая точка выхода в сеть: все запросы идут через одну keep-alive сессию
+        url = f"{BYBIT_BASE}{path}"
+        for attempt in range(self.max_retries + 1):
+            self._limiter.acquire()
+            r = self.session.get(url, params=params, timeout=timeout)
+            try:
+                return self._check(r)
+            except (RateLimitError, ServerError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                wait = self.retry_backoff_sec * 2 ** attempt  # тот же экспоненциальный шаг, что у Retry
+                logging.warning(f"{path}: {e}, повтор через {wait} с")
+                time.sleep(wait)
+
+    @cached(ttl=6 * 3600)  # список перпов почти не меняется между циклами
     def get_instruments(self) -> List[Dict[str, Any]]:
         """
         Все USDT линейные перпы со статусом Trading.
         Пагинация через nextPageCursor.
         """
-        url = f"{BYBIT_BASE}/v5/market/instruments-info"
+        path = "/v5/market/instruments-info"
         params = {"category": self.category, "limit": 1000}
         out: List[Dict[str, Any]] = []
-        cursor = None
+        is_linear_cat = (self.category == "linear")
 
+        data = self._get(path, params)
         while True:
-            if cursor:
-                params["cursor"] = cursor
-            r = self.session.get(url, params=params, headers=self._headers_public(), timeout=20)
-            data = self._check(r)
             result = data.get("result", {}) or {}
             items = result.get("list", []) or []
+            cursor = result.get("nextPageCursor")
+            # следующую страницу запрашиваем сразу, пока разбираем текущую
+            next_page = self._pager.submit(self._get, path, dict(params, cursor=cursor)) if cursor else None
 
             for it in items:
-                status = str(it.get("status", "")).lower()          # "trading"
-                symbol = it.get("symbol", "") or ""
-                quote = (it.get("quoteCoin") or it.get("quoteSymbol") or "").upper()
-                settle = (it.get("settleCoin") or "").upper()
-                contract_type = str(it.get("contractType", "")).lower()
-
-                is_usdt = ("USDT" in quote) or ("USDT" in settle) or symbol.endswith("USDT")
-                is_trading = ("trading" in status)
-                is_linear_perp = True
-                if self.category == "linear" and contract_type:
-                    is_linear_perp = ("perpetual" in contract_type)
-
-                if is_usdt and is_trading and is_linear_perp:
+                # Bybit отдаёт канонический регистр: "Trading", "USDT", "LinearPerpetual"
+                get = it.get
+                ctype = get("contractType") or ""
+                if (
+                    get("status") == "Trading"
+                    and (
+                        (get("quoteCoin") or get("quoteSymbol")) == "USDT"
+                        or get("settleCoin") == "USDT"
+                        or (get("symbol") or "").endswith("USDT")
+                    )
+                    and (not is_linear_cat or not ctype or ctype == "LinearPerpetual")
+                ):
                     out.append(it)
 
-            cursor = result.get("nextPageCursor")
-            if not cursor:
+            if next_page is None:
                 break
-            self._sleep()
+            data = next_page.result()
 
         logging.info(f"Найдено {len(out)} торгуемых USDT-перпетуалов.")
-        self._sleep()
         return out
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+    @cached(ttl=120)
     def get_tickers(self) -> List[Dict[str, Any]]:
         """
         /v5/market/tickers — один запрос, возвращает 24h high/low/last и др.
         Используем для быстрого префильтра по 24h range%.
         """
-        url = f"{BYBIT_BASE}/v5/market/tickers"
-        params = {"category": self.category}
-        r = self.session.get(url, params=params, headers=self._headers_public(), timeout=20)
-        data = self._check(r)
+        data = self._get("/v5/market/tickers", self._tickers_params)
         items = data.get("result", {}).get("list", []) or []
-        self._sleep()
         return items
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-    def get_klines(self, symbol: str, interval: str, limit: int = 200) -> List[Dict[str, Any]]:
+    def get_klines(self, symbol: str, interval: str, limit: int = 200) -> Dict[str, np.ndarray]:
         """
         /v5/market/kline
         interval: 1,3,5,15,30,60,120,240,360,720,D,W,M
+        Возвращает колонки numpy-массивами (по возрастанию ts): ts, open, high, low, close, volume, turnover.
         """
-        url = f"{BYBIT_BASE}/v5/market/kline"
-        params = {
-            "category": self.category,
-            "symbol": symbol,
-            "interval": interval,
-            "limit": limit
-        }
-        r = self.session.get(url, params=params, headers=self._headers_public(), timeout=20)
-        data = self._check(r)
+        params = dict(self._kline_params, symbol=symbol, interval=interval, limit=limit)
+        data = self._get("/v5/market/kline", params)
         lst = data.get("result", {}).get("list", []) or []
-        lst_sorted = sorted(lst, key=lambda x: int(x[0]))
-        self._sleep()
-        return [
-            {
-                "ts": int(x[0]),
-                "open": float(x[1]),
-                "high": float(x[2]),
-                "low": float(x[3]),
-                "close": float(x[4]),
-                "volume": float(x[5]),
-                "turnover": float(x[6]) if len(x) > 6 and x[6] not in (None, "") else math.nan,
-            } for x in lst_sorted
-        ]
-
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+        if not lst:
+            return {k: np.empty(0) for k in KLINE_FIELDS}
+        lst.sort(key=lambda x: int(x[0]))
+        arr = np.asarray(lst, dtype=object)
+        out = {"ts": arr[:, 0].astype(np.int64)}
+        for i, name in enumerate(KLINE_FIELDS[1:6], 1):
+            out[name] = arr[:, i].astype(np.float64)
+        if arr.shape[1] > 6:
+            out["turnover"] = np.array([float(v) if v not in (None, "") else np.nan for v in arr[:, 6]])
+        else:
+            out["turnover"] = np.full(len(lst), np.nan)
+        return out
+
     def get_open_interest(self, symbol: str, interval: str = "1h") -> Optional[float]:
         """
         /v5/market/open-interest (public). Возвращаем последнее значение.
         """
-        url = f"{BYBIT_BASE}/v5/market/open-interest"
-        params = {
-            "category": self.category,
-            "symbol": symbol,
-            "interval": interval,
-            "limit": 1
-        }
-        r = self.session.get(url, params=params, headers=self._headers_public(), timeout=15)
-        data = self._check(r)
+        params = dict(self._oi_params, symbol=symbol, interval=interval)
+        data = self._get("/v5/market/open-interest", params, timeout=15)
         lst = data.get("result", {}).get("list", []) or []
-        self._sleep()
         if not lst:
             return None
         try:
@@ -0,0 +1,43 @@
+# cache.py
+import os
+import json
+import time
+import logging
+from typing import Any, Optional
+
+
+class FileCache:
+    """
+    Простой TTL-кэш на диске: один ключ = один файл {path}/{key}.json
+    с содержимым {"ts": epoch, "data": ...}.
+    """
+    def __init__(self, path: str = ".cache", default_ttl: int = 300):
+        self.path = path
+        self.default_ttl = default_ttl
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key: str, ttl: Optional[int] = None) -> Optional[Any]:
+        ttl = self.default_ttl if ttl is None else ttl
+        try:
+            with open(self._file(key), "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            if time.time() - float(payload.get("ts", 0)) > ttl:
+                return None
+            return payload.get("data")
+        except Exception:
+            # битый/чужой файл — просто промах, set() его перезапишет
+            return None
+
+    def set(self, key: str, value: Any):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fp = self._file(key)
+            tmp = fp + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"ts": time.time(), "data": value}, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, fp)
+        except Exception as e:
+            # кэш — оптимизация, падать из-за него нельзя
+            logging.warning(f"Не удалось записать кэш {key}: {e}")
@@ -1,30 +1,62 @@
 # indicators.py
+# Все индикаторы работают с numpy-массивами, время — по последней оси:
+# 1-D (один ряд) или 2-D (N символов × L баров, считаются за один проход).
 import numpy as np
-import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
-def ema(series: pd.Series, period: int) -> pd.Series:
-    return series.ewm(span=period, adjust=False).mean()
+def ewm(x: np.ndarray, alpha: float) -> np.ndarray:
+    """
+    Рекуррентное EMA: y[0] = x[0], y[i] = alpha * x[i] + (1 - alpha) * y[i-1].
+    Внутри время переносится на первую ось, чтобы каждый шаг цикла работал
+    с непрерывным срезом по всем символам сразу.
+    """
+    xt = np.moveaxis(np.asarray(x, dtype=np.float64), -1, 0)
+    ax = xt * alpha  # alpha * x заранее, одним векторным проходом
+    beta = 1.0 - alpha
+    yt = np.empty_like(ax)
+    yt[0] = xt[0]
+    for i in range(1, yt.shape[0]):
+        yt[i] = ax[i] + beta * yt[i - 1]
+    return np.moveaxis(yt, 0, -1)
 
-def macd(close: pd.Series, fast=12, slow=26, signal=9):
-    macd_line = ema(close, fast) - ema(close, slow)
+def ema(x: np.ndarray, period: int) -> np.ndarray:
+    # то же, что pandas ewm(span=period, adjust=False).mean()
+    return ewm(x, 2.0 / (period + 1))
+
+def macd(close: np.ndarray, fast=12, slow=26, signal=9):
+    macd_line = ema(close, fast)
+    macd_line -= ema(close, slow)  # in-place, без лишнего массива
     signal_line = ema(macd_line, signal)
     hist = macd_line - signal_line
     return macd_line, signal_line, hist
 
-def rsi(close: pd.Series, period: int = 14):
-    delta = close.diff()
-    gain = (delta.where(delta > 0, 0.0)).rolling(window=period).mean()
-    loss = (-delta.where(delta < 0, 0.0)).rolling(window=period).mean()
-    rs = gain / (loss.replace(0, np.nan))
-    rsi = 100 - (100 / (1 + rs))
-    return rsi.fillna(50.0)
+def _rolling_mean(x: np.ndarray, period: int) -> np.ndarray:
+    # скользящее среднее по последней оси; первые period-1 значений — NaN
+    out = np.full(x.shape, np.nan)
+    if x.shape[-1] >= period:
+        out[..., period - 1:] = sliding_window_view(x, period, axis=-1).mean(axis=-1)
+    return out
+
+def rsi(close: np.ndarray, period: int = 14):
+    close = np.asarray(close, dtype=np.float64)
+    # нулевая delta на первом баре, как close.diff().where(...) в pandas
+    delta = np.diff(close, axis=-1, prepend=close[..., :1])
+    gain = _rolling_mean(np.where(delta > 0, delta, 0.0), period)
+    loss = _rolling_mean(np.where(delta < 0, -delta, 0.0), period)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rs = gain / np.where(loss == 0, np.nan, loss)
+        out = 100 - (100 / (1 + rs))
+    return np.nan_to_num(out, nan=50.0)
 
-def atr(high: pd.Series, low: pd.Series, close: pd.Series, period: int = 14):
-    prev_close = close.shift(1)
-    tr = pd.concat([
-        (high - low),
-        (high - prev_close).abs(),
-        (low - prev_close).abs()
-    ], axis=1).max(axis=1)
-    atr_series = tr.ewm(span=period, adjust=False).mean()
-    return atr_series
+def atr(high: np.ndarray, low: np.ndarray, close: np.ndarray, period: int = 14):
+    high = np.asarray(high, dtype=np.float64)
+    low = np.asarray(low, dtype=np.float64)
+    close = np.asarray(close, dtype=np.float64)
+    tr = high - low
+    prev_close = close[..., :-1]
+    tr[..., 1:] = np.maximum.reduce([
+        tr[..., 1:],
+        np.abs(high[..., 1:] - prev_close),
+        np.abs(low[..., 1:] - prev_close),
+    ])
+    return ema(tr, period)
@@ -1,12 +1,15 @@
 # main.py
 import os
 import time
+import signal
 import logging
+import threading
 from dotenv import load_dotenv
-import pandas as pd
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from bybit_api import BybitAPI
+from cache import FileCache
 from indicators import macd, rsi, atr
 from telegram_utils import TelegramClient
 from reporter import build_report_txt, write_report_file
@@ -63,25 +66,66 @@ def check_sort_tf(sort_tf: str, timeframes):
     return timeframes[0]
 
 
-def kline_to_df(klines):
-    return pd.DataFrame(klines)[["open", "high", "low", "close"]].astype(float)
-
-
-def compute_indicators(df: pd.DataFrame, macd_fast, macd_slow, macd_signal, rsi_period, atr_period):
-    macd_line, signal_line, hist = macd(df["close"], macd_fast, macd_slow, macd_signal)
-    rsi_series = rsi(df["close"], rsi_period)
-    atr_series = atr(df["high"], df["low"], df["close"], atr_period)
-    return macd_line, signal_line, hist, rsi_series, atr_series
-
-
-def classify_trend(macd_line: pd.Series, signal_line: pd.Series, hist: pd.Series) -> str:
-    bull = (macd_line.iloc[-1] > signal_line.iloc[-1]) and (hist.iloc[-1] > 0)
-    bear = (macd_line.iloc[-1] < signal_line.iloc[-1]) and (hist.iloc[-1] < 0)
-    if bull:
-        return "BULL"
-    if bear:
-        return "BEAR"
-    return "NEUTRAL"
+def stack_klines(kl_by_sym, fields):
+    """
+    Группирует klines (dict колонок-массивов) по длине ряда и складывает выбранные
+    колонки в матрицы (N, L). Отдаёт (symbols, [matrix по каждому полю]).
+    """
+    groups = {}
+    for sym, kl in kl_by_sym.items():
+        groups.setdefault(len(kl["close"]), []).append(sym)
+    for syms in groups.values():
+        yield syms, [np.vstack([kl_by_sym[s][f] for s in syms]) for f in fields]
+
+
+def compute_macd(close, macd_fast, macd_slow, macd_signal):
+    return macd(close, macd_fast, macd_slow, macd_signal)
+
+
+def compute_rsi_atr(high, low, close, rsi_period, atr_period):
+    return rsi(close, rsi_period), atr(high, low, close, atr_period)
+
+
+def classify_trend(macd_line: np.ndarray, signal_line: np.ndarray, hist: np.ndarray) -> np.ndarray:
+    """
+    Тренд по последнему бару для каждой строки: BULL / BEAR / NEUTRAL.
+    """
+    m, s, h = macd_line[..., -1], signal_line[..., -1], hist[..., -1]
+    bull = (m > s) & (h > 0)
+    bear = (m < s) & (h < 0)
+    return np.where(bull, "BULL", np.where(bear, "BEAR", "NEUTRAL"))
+
+
+def trends_batch(kl_by_sym, macd_fast, macd_slow, macd_signal):
+    """
+    MACD-тренд одного ТФ сразу для всех символов (один векторный проход на группу
+    рядов одинаковой длины). Возвращает {sym: "BULL" | "BEAR" | "NEUTRAL"}.
+    """
+    out = {}
+    for syms, (close,) in stack_klines(kl_by_sym, ("close",)):
+        trends = classify_trend(*compute_macd(close, macd_fast, macd_slow, macd_signal))
+        out.update(zip(syms, trends.tolist()))
+    return out
+
+
+def rsi_atr_batch(kl_by_sym, rsi_period, atr_period):
+    """
+    RSI и ATR одного ТФ по последнему бару: {sym: {"rsi", "atr_abs", "atr_pct"}}.
+    Считается только для пар, прошедших фильтр по MACD.
+    """
+    out = {}
+    for syms, (high, low, close) in stack_klines(kl_by_sym, ("high", "low", "close")):
+        rsi_m, atr_m = compute_rsi_atr(high, low, close, rsi_period, atr_period)
+        last_close = close[:, -1]
+        atr_abs = atr_m[:, -1]
+        atr_pct = np.divide(atr_abs, last_close, out=np.zeros_like(atr_abs), where=last_close != 0)
+        for i, sym in enumerate(syms):
+            out[sym] = {
+                "rsi": float(rsi_m[i, -1]),
+                "atr_abs": float(atr_abs[i]),
+                "atr_pct": float(atr_pct[i]),
+            }
+    return out
 
 
 # ----- main loop -----
@@ -104,6 +148,7 @@ def main_loop():
     ATR_PERIOD = env_int("ATR_PERIOD", 14)
 
     SLEEP_MS = env_int("PER_REQUEST_SLEEP_MS", 250)
+    MAX_RPS = env_int("MAX_RPS", 0)  # 0 = WORKERS * 1000 / PER_REQUEST_SLEEP_MS
     MAX_RETRIES = env_int("MAX_RETRIES", 3)
     RETRY_BACKOFF = env_int("RETRY_BACKOFF_SEC", 2)
 
@@ -114,6 +159,9 @@ def main_loop():
     # === dynamic TFs from .env ===
     TIMEFRAMES = parse_timeframes(os.getenv("TIMEFRAMES", "4H,1D,1W"))
     SORT_TF = check_sort_tf(os.getenv("SORT_TF", TIMEFRAMES[0]), TIMEFRAMES)
+    # Порядок загрузки: от старшего ТФ к младшему (TF_TO_BYBIT упорядочен по возрастанию).
+    # Старший ТФ чаще всего NEUTRAL — такие пары отсеиваются до запросов по младшим ТФ.
+    TF_ORDER = sorted(TIMEFRAMES, key=list(TF_TO_BYBIT).index, reverse=True)
     logging.info(f"Активные таймфреймы: {', '.join(TIMEFRAMES)} | сортировка по ATR: {SORT_TF}")
 
     TG_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -134,165 +182,198 @@ def main_loop():
         api_key=api_key,
         api_secret=api_secret,
         recv_window=recv_window,
+        workers=WORKERS,
+        max_rps=MAX_RPS,
+        cache=FileCache(os.getenv("CACHE_DIR", ".cache")),
     )
 
-    while True:
-        logging.info("=== Новый цикл ===")
-        try:
-            # 1) Все USDT-перпы
-            instruments = api.get_instruments()
-            symbols = [it["symbol"] for it in instruments]
-            logging.info(f"Всего символов: {len(symbols)}")
-
-            # 2) Быстрый префильтр по /tickers
-            if USE_TICKERS_PREFILTER:
-                tickers = api.get_tickers()
-                tick_map = {t["symbol"]: t for t in tickers if t.get("symbol") in symbols}
-                rows = []
-                for sym, t in tick_map.items():
-                    try:
-                        high = float(t.get("highPrice24h") or t.get("highPrice") or 0)
-                        low = float(t.get("lowPrice24h") or t.get("lowPrice") or 0)
-                        last = float(t.get("lastPrice") or 0)
-                        if last <= 0 or high <= 0 or low <= 0:
-                            continue
-                        range_pct = (high - low) / last
-                        rows.append({"symbol": sym, "range24h_pct": range_pct})
-                    except Exception:
-                        continue
-                rows = sorted(rows, key=lambda x: x["range24h_pct"], reverse=True)
-                pre_count = max(TOP_N * PREFILTER_MULTIPLIER, TOP_N)
-                pre_top = [r["symbol"] for r in rows[:pre_count]]
-                logging.info(f"Префильтр по /tickers: выбрано {len(pre_top)} (multiplier={PREFILTER_MULTIPLIER}).")
-            else:
-                pre_top = symbols
-
-            # 3) Параллельно обрабатываем пары с выбранными ТФ
-            def load_pair(sym: str):
-                try:
-                    trends = {}
-                    rsis = {}
-                    atr_abs = {}
-                    atr_pct = {}
+    # SIGTERM (деплой на Render) / Ctrl+C: дорабатываем текущий шаг и выходим, не ждём конца сна
+    stop = threading.Event()
 
-                    for tf in TIMEFRAMES:
-                        interval = TF_TO_BYBIT[tf]
-                        limit = min(LIMIT, 120) if interval in LONG_TF_CODES else LIMIT
+    def on_signal(signum, frame):
+        logging.info(f"Получен сигнал {signum}, завершаю работу...")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    # Пулы потоков живут весь процесс: не пересоздаём воркеры на каждый цикл/этап
+    kline_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="kline")
+    oi_pool = ThreadPoolExecutor(max_workers=min(6, WORKERS), thread_name_prefix="oi")
+
+    try:
+        while not stop.is_set():
+            cycle_start = time.monotonic()
+            logging.info("=== Новый цикл ===")
+            try:
+                # 1) Все USDT-перпы
+                instruments = api.get_instruments()
+                symbols = [it["symbol"] for it in instruments]
+                symbols_set = frozenset(symbols)
+                logging.info(f"Всего символов: {len(symbols)}")
+
+                # 2) Быстрый префильтр по /tickers
+                if USE_TICKERS_PREFILTER:
+                    tickers = api.get_tickers()
+                    rows = []
+                    for t in tickers:
+                        sym = t.get("symbol")
+                        if sym not in symbols_set:
+                            continue
+                        try:
+                            high = float(t.get("highPrice24h") or t.get("highPrice") or 0)
+                            low = float(t.get("lowPrice24h") or t.get("lowPrice") or 0)
+                            last = float(t.get("lastPrice") or 0)
+                            if last <= 0 or high <= 0 or low <= 0:
+                                continue
+                            range_pct = (high - low) / last
+                            rows.append({"symbol": sym, "range24h_pct": range_pct})
+                        except Exception:
+                            continue
+                    rows = sorted(rows, key=lambda x: x["range24h_pct"], reverse=True)
+                    pre_count = max(TOP_N * PREFILTER_MULTIPLIER, TOP_N)
+                    pre_top = [r["symbol"] for r in rows[:pre_count]]
+                    logging.info(f"Префильтр по /tickers: выбрано {len(pre_top)} (multiplier={PREFILTER_MULTIPLIER}).")
+                else:
+                    pre_top = symbols
+
+                # 3) По ТФ от старшего к младшему: грузим свечи только для выживших пар,
+                #    считаем индикаторы одним векторным проходом и отсеиваем NEUTRAL/расхождения
+                def load_klines(sym: str, tf: str):
+                    if stop.is_set():  # при остановке быстро сливаем очередь пула
+                        return sym, None
+                    interval = TF_TO_BYBIT[tf]
+                    limit = min(LIMIT, 120) if interval in LONG_TF_CODES else LIMIT
+                    try:
                         kl = api.get_klines(sym, interval, limit=limit)
-                        # Требования к числу баров: для недель/месяцев хватит 30, для остальных ≥ 50
-                        if (interval in LONG_TF_CODES and len(kl) < 30) or (interval not in LONG_TF_CODES and len(kl) < 50):
-                            return sym, None  # мало данных для одного из ТФ → пропуск пары
-
-                        df = kline_to_df(kl)
-                        m_line, s_line, h_line, rsi_series, atr_series = compute_indicators(
-                            df, MACD_FAST, MACD_SLOW, MACD_SIGNAL, RSI_PERIOD, ATR_PERIOD
-                        )
-                        trend = classify_trend(m_line, s_line, h_line)
-                        trends[tf] = trend
-                        rsis[tf] = float(rsi_series.iloc[-1])
-
-                        last_close = float(df["close"].iloc[-1])
-                        atr_abs_val = float(atr_series.iloc[-1])
-                        atr_pct_val = (atr_abs_val / last_close) if last_close else 0.0
-                        atr_abs[tf] = atr_abs_val
-                        atr_pct[tf] = atr_pct_val
-
-                    # Все выбранные ТФ должны иметь одинаковый тренд (BULL или BEAR)
-                    uniq = set(trends.values())
-                    if "NEUTRAL" in uniq or len(uniq) != 1:
+                        n_bars = len(kl["close"])
+                    except Exception as e:
+                        logging.debug(f"[{sym}] ошибка загрузки свечей {tf}: {e}")
                         return sym, None
-                    common = uniq.pop()
+                    # Требования к числу баров: для недель/месяцев хватит 30, для остальных ≥ 50
+                    if (interval in LONG_TF_CODES and n_bars < 30) or (interval not in LONG_TF_CODES and n_bars < 50):
+                        return sym, None
+                    return sym, kl
+
+                survivors = list(pre_top)
+                common = {}  # sym -> общий тренд по уже пройденным ТФ
+                kept = {}    # sym -> {tf: klines}; свечи выживших, чтобы не перезапрашивать
+                for tf in TF_ORDER:
+                    kl_tf = {}
+                    futs = [kline_pool.submit(load_klines, s, tf) for s in survivors]
+                    for f in as_completed(futs):
+                        sym, kl = f.result()
+                        if kl is not None:  # мало данных/ошибка → пропуск пары
+                            kl_tf[sym] = kl
+
+                    trends = trends_batch(kl_tf, MACD_FAST, MACD_SLOW, MACD_SIGNAL)
+                    alive = []
+                    for sym in survivors:
+                        trend = trends.get(sym)
+                        # Все выбранные ТФ должны иметь одинаковый тренд (BULL или BEAR)
+                        if trend is None or trend == "NEUTRAL" or common.get(sym, trend) != trend:
+                            continue
+                        common[sym] = trend
+                        kept.setdefault(sym, {})[tf] = kl_tf[sym]
+                        alive.append(sym)
+                    logging.info(f"{tf}: с общим трендом {len(alive)} из {len(survivors)}")
+                    survivors = alive
+
+                if stop.is_set():
+                    break  # прерванный скан не отправляем
+
+                # RSI/ATR — только для выживших пар, по тем же свечам
+                ind = {
+                    tf: rsi_atr_batch({sym: kept[sym][tf] for sym in survivors}, RSI_PERIOD, ATR_PERIOD)
+                    for tf in TIMEFRAMES
+                }
 
-                    payload = {
-                        "common_trend": common,
-                        "atr_abs_map": atr_abs,
-                        "atr_pct_map": atr_pct,
-                        "rsi_map": rsis,
+                results = {}
+                for sym in survivors:
+                    results[sym] = {
+                        "common_trend": common[sym],
+                        "atr_abs_map": {tf: ind[tf][sym]["atr_abs"] for tf in TIMEFRAMES},
+                        "atr_pct_map": {tf: ind[tf][sym]["atr_pct"] for tf in TIMEFRAMES},
+                        "rsi_map": {tf: ind[tf][sym]["rsi"] for tf in TIMEFRAMES},
                         # удобные ключи для прежней логики отбора TOP_N по SORT_TF:
-                        "atr_sort_abs": atr_abs.get(SORT_TF, 0.0),
-                        "atr_sort_pct": atr_pct.get(SORT_TF, 0.0),
+                        "atr_sort_abs": ind[SORT_TF][sym]["atr_abs"],
+                        "atr_sort_pct": ind[SORT_TF][sym]["atr_pct"],
                     }
-                    return sym, payload
-                except Exception as e:
-                    logging.debug(f"[{sym}] ошибка загрузки/индикаторов: {e}")
-                    return sym, None
-
-            results = {}
-            with ThreadPoolExecutor(max_workers=WORKERS) as ex:
-                futs = [ex.submit(load_pair, s) for s in pre_top]
-                for f in as_completed(futs):
-                    sym, data = f.result()
-                    if data:
-                        results[sym] = data
-
-            # 4) Делим на BULL/BEAR, ограничиваем по TOP_N (отбор по ATR% SORT_TF — как раньше)
-            bull_list, bear_list = [], []
-            for sym, d in results.items():
-                base = {
-                    "symbol": f"{sym.replace('USDT', '')}/USDT",
-                    "atr_abs": d["atr_sort_abs"],     # для внутренней сортировки/истории
-                    "atr_pct": d["atr_sort_pct"],     # для внутренней отсечки TOP_N
-                }
-                # добавим ATR% и RSI по каждому ТФ в явные ключи: atr_pct_{tf}, rsi_{tf}
-                for tf in TIMEFRAMES:
-                    base[f"rsi_{tf}"] = d["rsi_map"].get(tf, 0.0)
-                    base[f"atr_pct_{tf}"] = d["atr_pct_map"].get(tf, 0.0)
-
-                if d["common_trend"] == "BULL":
-                    bull_list.append(base)
-                elif d["common_trend"] == "BEAR":
-                    bear_list.append(base)
-
-            # ограничим по TOP_N по ATR% SORT_TF (как и было)
-            bull_list = sorted(bull_list, key=lambda x: x["atr_pct"], reverse=True)[:TOP_N]
-            bear_list = sorted(bear_list, key=lambda x: x["atr_pct"], reverse=True)[:TOP_N]
-            logging.info(f"Финальный отбор ({'+'.join(TIMEFRAMES)}): BULL={len(bull_list)} BEAR={len(bear_list)}")
-
-            # 5) Open Interest — только для финальных списков
-            def add_oi(item):
-                sym = item["symbol"].replace("/USDT", "USDT")
-                try:
-                    oi = api.get_open_interest(sym, interval="1h") or 0.0
-                except Exception:
-                    oi = 0.0
-                item["oi"] = oi
-                return item
-
-            with ThreadPoolExecutor(max_workers=min(6, WORKERS)) as ex:
-                bull_list = list(ex.map(add_oi, bull_list))
-                bear_list = list(ex.map(add_oi, bear_list))
-
-            # 6) Итоговая сортировка для вывода: по сумме RSI по всем выбранным ТФ (по убыванию)
-            def rsi_sum(item):
-                total = 0.0
-                for tf in TIMEFRAMES:
-                    total += float(item.get(f"rsi_{tf}", 0.0))
-                return total
-
-            bull_sorted = sorted(bull_list, key=rsi_sum, reverse=True)
-            bear_sorted = sorted(bear_list, key=rsi_sum, reverse=True)
-
-            # 7) Формируем .txt и сохраняем
-            report_text = build_report_txt(
-                bull_sorted,
-                bear_sorted,
-                timeframes=TIMEFRAMES,
-                sort_tf=SORT_TF,            # в шапке оставляем какой ТФ использован для TOP_N
-                tz="Europe/Kyiv",
-            )
-            filepath = write_report_file(report_text)
-
-            # 8) История (JSON)
-            append_history({"bull": bull_sorted, "bear": bear_sorted, "timeframes": TIMEFRAMES, "sort_tf": SORT_TF})
-
-            # 9) Telegram
-            tg.send_document(filepath, caption=f"BYBIT MACD Scanner — отчёт ({' & '.join(TIMEFRAMES)})")
-
-        except Exception as e:
-            logging.exception(f"Фатальная ошибка цикла: {e}")
-
-        logging.info(f"Сон на {SCAN_INTERVAL_MINUTES} мин...")
-        time.sleep(SCAN_INTERVAL_MINUTES * 60)
+
+                # 4) Делим на BULL/BEAR, ограничиваем по TOP_N (отбор по ATR% SORT_TF — как раньше)
+                bull_list, bear_list = [], []
+                for sym, d in results.items():
+                    base = {
+                        "symbol": f"{sym.replace('USDT', '')}/USDT",  # для отчёта
+                        "raw_symbol": sym,                              # для запросов к API
+                        "atr_abs": d["atr_sort_abs"],     # для внутренней сортировки/истории
+                        "atr_pct": d["atr_sort_pct"],     # для внутренней отсечки TOP_N
+                    }
+                    # добавим ATR% и RSI по каждому ТФ в явные ключи: atr_pct_{tf}, rsi_{tf}
+                    for tf in TIMEFRAMES:
+                        base[f"rsi_{tf}"] = d["rsi_map"].get(tf, 0.0)
+                        base[f"atr_pct_{tf}"] = d["atr_pct_map"].get(tf, 0.0)
+
+                    if d["common_trend"] == "BULL":
+                        bull_list.append(base)
+                    elif d["common_trend"] == "BEAR":
+                        bear_list.append(base)
+
+                # ограничим по TOP_N по ATR% SORT_TF (как и было)
+                bull_list = sorted(bull_list, key=lambda x: x["atr_pct"], reverse=True)[:TOP_N]
+                bear_list = sorted(bear_list, key=lambda x: x["atr_pct"], reverse=True)[:TOP_N]
+                logging.info(f"Финальный отбор ({'+'.join(TIMEFRAMES)}): BULL={len(bull_list)} BEAR={len(bear_list)}")
+
+                # 5) Open Interest — только для финальных списков
+                def add_oi(item):
+                    # item["oi"] всегда float: отчёт сравнивает его с нулём без проверок типа
+                    try:
+                        oi = float(api.get_open_interest(item["raw_symbol"], interval="1h") or 0.0)
+                    except Exception:
+                        oi = 0.0
+                    item["oi"] = oi
+                    return item
+
+                # одна волна запросов на оба списка: OI для BEAR не ждёт окончания BULL
+                # (add_oi дополняет элементы на месте)
+                list(oi_pool.map(add_oi, bull_list + bear_list))
+
+                # 6) Итоговая сортировка для вывода: по сумме RSI по всем выбранным ТФ (по убыванию)
+                def rsi_sum(item):
+                    total = 0.0
+                    for tf in TIMEFRAMES:
+                        total += float(item.get(f"rsi_{tf}", 0.0))
+                    return total
+
+                bull_sorted = sorted(bull_list, key=rsi_sum, reverse=True)
+                bear_sorted = sorted(bear_list, key=rsi_sum, reverse=True)
+
+                # 7) Формируем .txt и сохраняем
+                report_text = build_report_txt(
+                    bull_sorted,
+                    bear_sorted,
+                    timeframes=TIMEFRAMES,
+                    sort_tf=SORT_TF,            # в шапке оставляем какой ТФ использован для TOP_N
+                    tz="Europe/Kyiv",
+                )
+                filepath = write_report_file(report_text)
+
+                # 8) История (JSONL)
+                append_history({"bull": bull_sorted, "bear": bear_sorted, "timeframes": TIMEFRAMES, "sort_tf": SORT_TF})
+
+                # 9) Telegram
+                tg.send_document(filepath, caption=f"BYBIT MACD Scanner — отчёт ({' & '.join(TIMEFRAMES)})")
+
+            except Exception as e:
+                logging.exception(f"Фатальная ошибка цикла: {e}")
+
+            # Циклы стартуют с шагом SCAN_INTERVAL_MINUTES, время самого скана вычитаем из сна
+            sleep_sec = max(0.0, SCAN_INTERVAL_MINUTES * 60 - (time.monotonic() - cycle_start))
+            logging.info(f"Сон на {sleep_sec / 60:.1f} мин...")
+            stop.wait(sleep_sec)
+    finally:
+        kline_pool.shutdown(wait=False, cancel_futures=True)
+        oi_pool.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
@@ -1,40 +1,119 @@
 # reporter.py
+import io
 import os
-from typing import List, Dict
-from datetime import datetime
-import pytz
+import time
+from typing import Callable, List, Dict, Tuple
+from datetime import datetime, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+from utils import ensure_dirs
 
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", "output")
 LAST_REPORT = os.path.join(OUTPUT_DIR, "last_report.txt")
 
+_UTC = timezone.utc
+_TS_FMT = "%Y-%m-%d %H:%M:%S %Z"
+_FLOAT_SPECS = tuple(f".{n}f" for n in range(7))  # готовые format-спеки для nd = 0..6
+
+_RULE = "────────────────────────────────────────────────────────"
+_HEADER = (
+    "BYBIT MACD SCANNER ({tf_title}) — {dt}\n"
+    "Правила: выбранные ТФ должны иметь одинаковый тренд MACD (BULL или BEAR).\n"
+    "Отобрано TOP_N по ATR {sort_tf} (внутренняя отсечка),\n"
+    "в отчёте списки отсортированы по СУММЕ RSI по всем ТФ (по убыванию).\n"
+    f"{_RULE}\n"
+    "\n"
+)
+# строка пары: номер, символ, ATR и RSI по всем ТФ, OI (если есть) и пустая строка-разделитель
+_ROW = "{:02d}. {}\n    • ATR: {}\n    • RSI: {}\n{}\n"
+_OI_ROW = "    • OI: {}\n"
+
+
+@lru_cache(maxsize=16)
+def _get_tz(name: str):
+    # ZoneInfo неизменяем — держим сильные ссылки на уже разобранные зоны
+    return ZoneInfo(name)
+
+
+_ts_cache = (0, "", "")  # (секунда, tz, строка)
+
+
+def _cached_ts(tz: str) -> str:
+    # отформатированное время шапки живёт секунду: повторные отчёты в ту же секунду его переиспользуют
+    global _ts_cache
+    sec = int(time.time())
+    if _ts_cache[0] == sec and _ts_cache[1] == tz:
+        return _ts_cache[2]
+    tzobj = _UTC if tz == "UTC" else _get_tz(tz)
+    s = datetime.now(tzobj).strftime(_TS_FMT)
+    _ts_cache = (sec, tz, s)
+    return s
+
 
 def ensure_output_dir():
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # тот же OUTPUT_DIR, что и у истории — один флаг готовности на процесс
+    ensure_dirs()
 
 
 def format_float(x, nd=2):
+    spec = _FLOAT_SPECS[nd] if 0 <= nd < len(_FLOAT_SPECS) else f".{nd}f"
+    # частый случай — обычный float: точная проверка типа без isinstance и исключений
+    tx = type(x)
+    if tx is float:
+        return format(x, spec)
+    if x is None:
+        return "-"
+    # int (может не влезть во float), numpy-числа, строки и прочее — под общей защитой
     try:
-        return f"{float(x):.{nd}f}"
-    except Exception:
+        return format(x if tx is int else float(x), spec)
+    except (TypeError, ValueError, OverflowError):
         return "-"
 
 
-def _rsi_line(item: Dict, timeframes: List[str]) -> str:
-    parts = []
-    for tf in timeframes:
-        val = item.get(f"rsi_{tf}")
-        parts.append(f"{tf}: {format_float(val, 2)}")
-    return " | ".join(parts)
+def format_float_2(x):
+    # специализация под nd=2 (единственная точность в отчёте): константный спек, без выбора по nd
+    # int идёт через format_float: слишком большой int должен дать "-", а не OverflowError
+    if type(x) is float:
+        return format(x, ".2f")
+    return format_float(x, 2)
+
+
+def _tf_keys(prefix: str, timeframes: List[str]) -> List[Tuple[str, str]]:
+    # пары (tf, ключ в item) — собираем один раз на отчёт, а не на каждую строку
+    return [(tf, f"{prefix}{tf}") for tf in timeframes]
+
+
+def _rsi_line(item: Dict, rsi_keys: List[Tuple[str, str]]) -> str:
+    return " | ".join(f"{tf}: {format_float_2(item.get(k))}" for tf, k in rsi_keys)
 
 
-def _atr_line(item: Dict, timeframes: List[str]) -> str:
-    parts = []
-    for tf in timeframes:
-        val = item.get(f"atr_pct_{tf}")
-        # показываем только проценты, как просили
-        parts.append(f"{tf}: {format_float((val or 0) * 100, 2)}%")
-    return " | ".join(parts)
+def _atr_line(item: Dict, atr_keys: List[Tuple[str, str]]) -> str:
+    # показываем только проценты, как просили
+    return " | ".join(f"{tf}: {format_float_2((item.get(k) or 0) * 100)}%" for tf, k in atr_keys)
+
+
+def _write_section(
+    w: Callable[[str], int],
+    title: str,
+    items: List[Dict],
+    atr_keys: List[Tuple[str, str]],
+    rsi_keys: List[Tuple[str, str]],
+):
+    w(f"{title}\n{_RULE}\n")
+    if not items:
+        w("(пусто)\n\n")
+        return
+    # все обращения к item — одним списковым включением, дальше только запись
+    rows = [
+        (it["symbol"], _atr_line(it, atr_keys), _rsi_line(it, rsi_keys), it.get("oi") or 0.0)
+        for it in items
+    ]
+    # OI показываем только если > 0 (item["oi"] — float или None, см. add_oi в main.py)
+    w("".join([
+        _ROW.format(i, sym, atr_line, rsi_line, _OI_ROW.format(format_float_2(oi)) if oi > 0 else "")
+        for i, (sym, atr_line, rsi_line, oi) in enumerate(rows, 1)
+    ]))
 
 
 def build_report_txt(
@@ -44,48 +123,27 @@ def build_report_txt(
     sort_tf: str,
     tz: str = "UTC",
 ) -> str:
-    dt = datetime.now(pytz.timezone(tz)).strftime("%Y-%m-%d %H:%M:%S %Z")
+    dt = _cached_ts(tz)
     tf_title = ", ".join(timeframes)
-    lines = []
-    lines.append(f"BYBIT MACD SCANNER ({tf_title}) — {dt}")
-    lines.append("Правила: выбранные ТФ должны иметь одинаковый тренд MACD (BULL или BEAR).")
-    lines.append(f"Отобрано TOP_N по ATR {sort_tf} (внутренняя отсечка),")
-    lines.append("в отчёте списки отсортированы по СУММЕ RSI по всем ТФ (по убыванию).")
-    lines.append("────────────────────────────────────────────────────────")
-    lines.append("")
-
-    def section(title: str, items: List[Dict]):
-        lines.append(title)
-        lines.append("────────────────────────────────────────────────────────")
-        if not items:
-            lines.append("(пусто)")
-            lines.append("")
-            return
-        for i, it in enumerate(items, 1):
-            sym = it["symbol"]
-            oi = it.get("oi", 0.0)
-
-            lines.append(f"{i:02d}. {sym}")
-            # ATR: для каждого выбранного ТФ
-            lines.append(f"    • ATR: {_atr_line(it, timeframes)}")
-            # RSI: для каждого выбранного ТФ
-            lines.append(f"    • RSI: {_rsi_line(it, timeframes)}")
-            # OI показываем только если > 0
-            try:
-                if oi and float(oi) > 0:
-                    lines.append(f"    • OI: {format_float(oi, 2)}")
-            except Exception:
-                pass
-            lines.append("")
-
-    section("BULL:", bull_list)
-    section("BEAR:", bear_list)
-
-    return "\n".join(lines)
+    rsi_keys = _tf_keys("rsi_", timeframes)
+    atr_keys = _tf_keys("atr_pct_", timeframes)
+    buf = io.StringIO()
+    w = buf.write
+    w(_HEADER.format(tf_title=tf_title, dt=dt, sort_tf=sort_tf))
+
+    _write_section(w, "BULL:", bull_list, atr_keys, rsi_keys)
+    _write_section(w, "BEAR:", bear_list, atr_keys, rsi_keys)
+
+    # как прежний "\n".join(lines): без перевода строки после последней (пустой) строки
+    return buf.getvalue()[:-1]
 
 
 def write_report_file(text: str) -> str:
     ensure_output_dir()
-    with open(LAST_REPORT, "w", encoding="utf-8") as f:
-        f.write(text)
+    # пишем байты во временный файл и атомарно подменяем: читатель всегда видит целый отчёт
+    data = text.encode("utf-8")  # кодируем до открытия файла: ошибка не оставит пустой .tmp
+    tmp = LAST_REPORT + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, LAST_REPORT)
     return LAST_REPORT
@@ -1,33 +1,86 @@
 # utils.py
 import os
-import json
 import time
+import atexit
 import logging
-from datetime import datetime, timezone
-from typing import Any, Dict
+import orjson
+try:
+    import fcntl  # блокировка файла истории (POSIX; на Windows без неё)
+except ImportError:
+    fcntl = None
+from typing import Any, Dict, List, Optional
 
 OUTPUT_DIR = os.getenv("OUTPUT_DIR", "output")
-HISTORY_JSON = os.path.join(OUTPUT_DIR, "filtered_pairs_history.json")
+# История — JSON Lines: одна запись на строку, дописываем в конец без перечитывания файла
+HISTORY_JSONL = os.path.join(OUTPUT_DIR, "filtered_pairs_history.jsonl")
+LEGACY_HISTORY_JSON = os.path.join(OUTPUT_DIR, "filtered_pairs_history.json")
+
+# Буфер записей истории: сбрасываем пачкой по размеру, по времени или при выходе
+_FLUSH_SIZE = 64
+_FLUSH_INTERVAL_SEC = 300
+_pending: List[bytes] = []
+_last_flush: Optional[float] = None
+
+_dir_ready = False
 
 def ensure_dirs():
-    if not os.path.exists(OUTPUT_DIR):
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # makedirs(exist_ok=True) идемпотентен; после первого успеха не трогаем ФС вовсе
+    global _dir_ready
+    if _dir_ready:
+        return
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    _dir_ready = True
 
 def ts_now_iso():
-    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    # фиксированный формат UTC: целочисленное форматирование без tz-объекта и strftime
+    t = time.gmtime()
+    return f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}Z"
 
-def append_history(payload: Dict[str, Any]):
-    ensure_dirs()
-    record = {"ts": ts_now_iso(), **payload}
-    if not os.path.exists(HISTORY_JSON):
-        with open(HISTORY_JSON, "w", encoding="utf-8") as f:
-            json.dump([record], f, ensure_ascii=False, indent=2)
+def migrate_legacy_history():
+    """
+    Одноразово переносит старую историю (JSON-массив) в JSONL.
+    Старый файл переименовывается в *.migrated, чтобы не переносить его повторно.
+    """
+    if not os.path.exists(LEGACY_HISTORY_JSON) or os.path.exists(HISTORY_JSONL):
         return
     try:
-        with open(HISTORY_JSON, "r", encoding="utf-8") as f:
-            arr = json.load(f)
-    except Exception:
-        arr = []
-    arr.append(record)
-    with open(HISTORY_JSON, "w", encoding="utf-8") as f:
-        json.dump(arr, f, ensure_ascii=False, indent=2)
+        with open(LEGACY_HISTORY_JSON, "rb") as f:
+            arr = orjson.loads(f.read())
+    except Exception as e:
+        logging.warning(f"Не удалось прочитать старую историю {LEGACY_HISTORY_JSON}: {e}")
+        return
+    # пишем во временный файл: недописанный .jsonl иначе навсегда заблокировал бы перенос
+    tmp = HISTORY_JSONL + ".tmp"
+    with open(tmp, "wb") as f:
+        for record in arr:
+            f.write(orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS) + b"\n")
+    os.replace(tmp, HISTORY_JSONL)
+    os.replace(LEGACY_HISTORY_JSON, LEGACY_HISTORY_JSON + ".migrated")
+    logging.info(f"История перенесена в {HISTORY_JSONL} ({len(arr)} записей).")
+
+def flush_history():
+    global _last_flush
+    _last_flush = time.monotonic()
+    if not _pending:
+        return
+    ensure_dirs()
+    migrate_legacy_history()
+    # O(1) дозапись в конец под эксклюзивной блокировкой: параллельные процессы не перемешивают строки
+    with open(HISTORY_JSONL, "ab") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.write(b"".join(_pending))
+        f.flush()
+    _pending.clear()
+
+atexit.register(flush_history)
+
+def append_history(payload: Dict[str, Any]):
+    record = {"ts": ts_now_iso(), **payload}
+    _pending.append(orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS) + b"\n")
+    if (
+        len(_pending) >= _FLUSH_SIZE
+        or _last_flush is None
+        or time.monotonic() - _last_flush >= _FLUSH_INTERVAL_SEC
+    ):
+        flush_history()